@@ -1,9 +1,12 @@
 import os
+import re
 import json
-from typing import Literal
+import asyncio
+from collections import deque
+from typing import Any, Dict, List, Literal, Optional, Tuple
 
 from langchain_google_vertexai import ChatVertexAI
-from langchain_core.messages import SystemMessage, HumanMessage
+from langchain_core.messages import AIMessage, BaseMessage, SystemMessage, HumanMessage
 from langgraph.graph import StateGraph, END
 
 from state import AgentState
@@ -12,16 +15,21 @@ from memory_bank import MemoryBank
 from validators import validate_sql_safety, SQLSecurityError
 from prompts import (
     SCHEMA_SELECTOR_PROMPT,
-    SQL_GEN_SYSTEM,
+    SQL_GEN_SYSTEM_STATIC,
+    SQL_GEN_SYSTEM_DYNAMIC,
     SQL_GEN_USER,
     SQL_FIX_USER,
+    SCHEMA_AND_SQL_STATIC,
+    SCHEMA_AND_SQL_DYNAMIC,
     ANSWER_SYNTHESIS_PROMPT,
-    ERROR_RESPONSE_PROMPT
+    ERROR_RESPONSE_PROMPT,
+    compile_prompt
 )
 from google.cloud import bigquery
 
 # Global Lazy Managers
 _llm = None
+_sampling_llm = None
 _bq_client = None
 _schema_manager = None
 _memory_bank = None
@@ -32,6 +40,13 @@ def get_llm():
         _llm = ChatVertexAI(model="gemini-2.0-flash-exp", temperature=0)
     return _llm
 
+def get_sampling_llm():
+    """Second SQL generator, sampled at a higher temperature to diversify candidates."""
+    global _sampling_llm
+    if _sampling_llm is None:
+        _sampling_llm = ChatVertexAI(model="gemini-2.0-flash-exp", temperature=SAMPLING_TEMPERATURE)
+    return _sampling_llm
+
 def get_bq_client():
     global _bq_client
     if _bq_client is None:
@@ -41,7 +56,8 @@ def get_bq_client():
 def get_schema_manager():
     global _schema_manager
     if _schema_manager is None:
-        _schema_manager = SchemaManager()
+        # Shares the execution client (and its connection pool)
+        _schema_manager = SchemaManager(client=get_bq_client())
     return _schema_manager
 
 def get_memory_bank():
@@ -50,154 +66,451 @@ def get_memory_bank():
         _memory_bank = MemoryBank()
     return _memory_bank
 
-# --- NODES ---
+# Temperature of the second SQL candidate generated alongside the greedy one
+SAMPLING_TEMPERATURE = 0.4
 
-def select_schema_node(state: AgentState):
-    """Determines which tables are relevant."""
-    print("--- Selecting Schema ---")
-    user_q = state["messages"][-1][1] if isinstance(state["messages"][-1], tuple) else state["messages"][-1].content
-    
+# BigQuery column types returned as date/time objects
+DATE_FIELD_TYPES = frozenset({"DATE", "DATETIME", "TIMESTAMP", "TIME"})
+
+# Limit to max 8 tables to avoid overwhelming the LLM
+MAX_TABLES_FOR_SELECTION = 8
+
+# Table selections kept per (normalized question, table list)
+TABLE_SELECTION_CACHE_SIZE = 512
+_table_selection_cache: Dict[Tuple[str, Tuple[str, ...]], Tuple[str, ...]] = {}
+
+# Up to this many tables, every schema is inlined and tables + SQL come from
+# one LLM call; bigger datasets use a separate schema-selection call first
+FUSED_MAX_TABLES = 12
+
+# Q&A turns kept in conversation_history; older turns are dropped
+MAX_CONVERSATION_HISTORY = 8
+
+# Size of the query result shown to the LLM, ~500 tokens
+MAX_RESULT_CHARS = 2000
+# Compact separators save tokens; default=str covers NUMERIC (Decimal) and BYTES cells
+_RESULT_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"), default=str)
+
+# Hard cap on rows fetched from BigQuery per query
+MAX_ROWS = 100
+# Queries that would scan more than this fail instead of running up a bill
+MAX_BYTES_BILLED = 10**9
+
+_LIMIT_RE = re.compile(r"\blimit\b", re.IGNORECASE)
+# Markdown code fences and the language tags the LLM sometimes prefixes SQL with
+_FENCE_RE = re.compile(r"```(?:sql|json)?\s*|\s*```")
+# Language tags the model sometimes puts before the query (compared lowercased)
+_SQL_PREFIXES = frozenset({"googlesql", "sql", "bigquery", "bq"})
+
+# Prompt templates, parsed once at import
+_schema_selector_prompt = compile_prompt(SCHEMA_SELECTOR_PROMPT)
+_sql_gen_system_dynamic = compile_prompt(SQL_GEN_SYSTEM_DYNAMIC)
+_sql_gen_user = compile_prompt(SQL_GEN_USER)
+_sql_fix_user = compile_prompt(SQL_FIX_USER)
+_schema_and_sql_dynamic = compile_prompt(SCHEMA_AND_SQL_DYNAMIC)
+_answer_synthesis_prompt = compile_prompt(ANSWER_SYNTHESIS_PROMPT)
+_error_response_prompt = compile_prompt(ERROR_RESPONSE_PROMPT)
+
+def _clean_sql(content: str) -> str:
+    """Strips markdown fences and language prefixes from an LLM SQL response."""
+    sql = _FENCE_RE.sub("", content).strip()
+    # Only the first word is looked at, however long the query is
+    parts = sql.split(None, 1)
+    if len(parts) == 2 and parts[0].lower() in _SQL_PREFIXES:
+        return parts[1]
+    return sql
+
+def _user_question(state: AgentState) -> str:
+    last = state["messages"][-1]
+    return last[1] if isinstance(last, tuple) else last.content
+
+def _selectable_tables() -> List[str]:
     all_tables = get_schema_manager().get_all_tables()
-    
-    # Limit to max 8 tables to avoid overwhelming the LLM
-    MAX_TABLES_FOR_SELECTION = 8
     if len(all_tables) > MAX_TABLES_FOR_SELECTION:
         print(f"Note: Dataset has {len(all_tables)} tables, showing first {MAX_TABLES_FOR_SELECTION} for selection")
         all_tables = all_tables[:MAX_TABLES_FOR_SELECTION]
-    
-    prompt = SCHEMA_SELECTOR_PROMPT.format(
+    return all_tables
+
+def _format_examples(examples: List[Dict[str, str]]) -> str:
+    return "\n".join([f"Q: {e['question']}\nSQL: {e['sql']}" for e in examples])
+
+def _format_conversation(conversation_history: List[Dict[str, str]]) -> str:
+    # Build conversation context (limit to last 3 exchanges to save tokens)
+    if not conversation_history:
+        return "No previous conversation."
+    recent_history = conversation_history[-3:]  # Last 3 Q&A pairs
+    return "Recent conversation:\n" + "\n".join([
+        f"Previous Q: {item['question']}\nPrevious SQL: {item['sql']}\nPrevious Answer: {item.get('answer', 'N/A')}"
+        for item in recent_history
+    ])
+
+def _parse_plan(content: str) -> Tuple[List[str], str]:
+    """
+    Parses the fused {"tables": [...], "sql": "..."} response; bare SQL is accepted too.
+    Raises ValueError on a JSON reply that doesn't have that shape.
+    """
+    text = _FENCE_RE.sub("", content).strip()
+    if not text.startswith("{"):
+        return [], _clean_sql(content)
+    try:
+        # strict=False: models often put raw newlines inside the "sql" string
+        plan = json.loads(text, strict=False)
+    except ValueError as e:
+        raise ValueError(f"Could not parse the generated plan as JSON ({e}). Return only the JSON object.")
+    tables = plan.get("tables", []) if isinstance(plan, dict) else None
+    sql = plan.get("sql") if isinstance(plan, dict) else None
+    if not (isinstance(tables, list) and all(isinstance(t, str) for t in tables) and isinstance(sql, str)):
+        raise ValueError('The generated plan must have a "tables" list of table names and an "sql" string.')
+    return tables, _clean_sql(sql)
+
+def _parse_plans(contents: List[str]) -> Tuple[List[Tuple[List[str], str]], Optional[str]]:
+    """Parses every candidate reply, dropping unparseable ones; returns the plans and the first parse error."""
+    plans = []
+    error = None
+    for content in contents:
+        try:
+            plans.append(_parse_plan(content))
+        except ValueError as e:
+            error = error or str(e)
+    return plans, error
+
+def _parse_error_update(state: AgentState, contents: List[str], error: str) -> Dict[str, Any]:
+    """
+    State update when no candidate could be parsed. Not a "Security Alert",
+    so it is retried: the fix prompt shows the model its own reply.
+    """
+    return {"candidate_sql": contents[0], "alternate_sqls": [], "error": error, "retry_count": state.get("retry_count", 0) + 1}
+
+# --- NODES ---
+
+async def _generate_candidates(prompt: List[BaseMessage]) -> List[str]:
+    """
+    Generates two replies concurrently: a greedy one and a sampled one.
+    The second costs no extra latency and often survives where the first
+    fails, saving a full fix cycle.
+    """
+    responses = await asyncio.gather(get_llm().ainvoke(prompt), get_sampling_llm().ainvoke(prompt))
+    return [response.content for response in responses]
+
+def _sql_key(sql: str) -> str:
+    """Whitespace-collapsed, case-folded SQL, so trivially different candidates compare equal."""
+    return " ".join(sql.rstrip().rstrip(";").casefold().split())
+
+def _candidate_update(sqls: List[str]) -> Dict[str, Any]:
+    """
+    State update for generated SQL: the greedy candidate plus any distinct
+    alternates. An alternate that only differs in case or whitespace is
+    dropped, so the common case skips the parallel dry runs, and so is a
+    sample that refused.
+    """
+    seen = {_sql_key(sqls[0])}
+    alternates = []
+    for sql in sqls[1:]:
+        key = _sql_key(sql)
+        if sql and key not in seen and "SECURITY_VIOLATION" not in sql:
+            seen.add(key)
+            alternates.append(sql)
+    return {"candidate_sql": sqls[0], "alternate_sqls": alternates}
+
+def _ask_relevant_tables(user_q: str, all_tables: Tuple[str, ...]) -> Tuple[str, ...]:
+    """
+    Asks the LLM which tables are relevant to the question.
+    Raises ValueError or TypeError on an unparseable reply.
+    """
+    prompt = _schema_selector_prompt(
         all_tables=", ".join(all_tables),
         user_question=user_q
     )
     
     # Simple JSON extraction (can be improved with JsonOutputParser)
     response = get_llm().invoke(prompt)
+    # Heuristic to find JSON list in response
+    content = response.content.replace("```json", "").replace("```", "").strip()
+    relevant_tables = json.loads(content)
+    # Verify they exist (set lookup, so large datasets stay linear)
+    known_tables = frozenset(all_tables)
+    return tuple(t for t in relevant_tables if t in known_tables)
+
+def _select_tables(user_q: str, all_tables: Tuple[str, ...]) -> Tuple[str, ...]:
+    """
+    Returns the tables relevant to the question. Cached on the normalized
+    question and the table list, so repeated questions skip the LLM call and
+    any change to the dataset's tables naturally misses the cache; the LLM
+    still sees the question as asked (quoted values, proper nouns).
+    An unparseable reply falls back to the first tables and isn't cached.
+    """
+    # Case and whitespace don't change which tables are needed
+    key = (" ".join(user_q.lower().split()), all_tables)
+    cached = _table_selection_cache.get(key)
+    if cached is not None:
+        return cached
+    
     try:
-        # Heuristic to find JSON list in response
-        content = response.content.replace("```json", "").replace("```", "").strip()
-        relevant_tables = json.loads(content)
-        # Verify they exist
-        relevant_tables = [t for t in relevant_tables if t in all_tables]
-    except:
+        relevant_tables = _ask_relevant_tables(user_q, all_tables)
+    except (ValueError, TypeError):
         # Fallback: Use first 3 tables (safer for token limits)
-        relevant_tables = all_tables[:3]
+        return all_tables[:3]
+    
+    if len(_table_selection_cache) >= TABLE_SELECTION_CACHE_SIZE:
+        # Evict the oldest entry (dicts keep insertion order)
+        _table_selection_cache.pop(next(iter(_table_selection_cache)), None)
+    _table_selection_cache[key] = relevant_tables
+    return relevant_tables
+
+async def select_schema_node(state: AgentState):
+    """Determines which tables are relevant and retrieves few-shot examples."""
+    print("--- Selecting Schema ---")
+    user_q = _user_question(state)
+    all_tables = _selectable_tables()
+    
+    # Retrieve examples (limit to 2 to save tokens) concurrently with the
+    # schema-selector LLM call - they only depend on the question
+    relevant_tables, examples = await asyncio.gather(
+        asyncio.to_thread(_select_tables, user_q, tuple(all_tables)),
+        asyncio.to_thread(get_memory_bank().retrieve_examples, user_q, k=2)
+    )
+    relevant_tables = list(relevant_tables)
     
     # Limit to max 3 tables to reduce token usage
     if len(relevant_tables) > 3:
         print(f"Limiting from {len(relevant_tables)} to 3 tables to reduce token usage")
         relevant_tables = relevant_tables[:3]
         
-    schema_context = get_schema_manager().get_formatted_schema_context(relevant_tables, max_tables=3)
+    # Cold tables are fetched from BigQuery, which blocks; keep the event loop
+    # free for other runs (e.g. concurrent Streamlit sessions)
+    schema_context = await asyncio.to_thread(get_schema_manager().get_formatted_schema_context, relevant_tables, max_tables=3)
     
     return {
         "user_query": user_q,
         "relevant_schema": schema_context,
+        "few_shot_examples": examples,
          # If this is a retry loop, keep existing context
     }
 
-def generate_sql_node(state: AgentState):
+async def generate_sql_node(state: AgentState):
     """Generates SQL using Schema + Few-Shot Examples."""
     print("--- Generating SQL ---")
     question = state["user_query"]
     schema = state["relevant_schema"]
     
-    # Retrieve examples (limit to 2 to save tokens)
-    examples = get_memory_bank().retrieve_examples(question, k=2)
-    few_shot_str = "\n".join([f"Q: {e['question']}\nSQL: {e['sql']}" for e in examples])
+    # Examples were fetched alongside schema selection; retries reuse them
+    few_shot_str = _format_examples(state.get("few_shot_examples", []))
+    conv_context = _format_conversation(state.get("conversation_history", []))
     
-    # Build conversation context (limit to last 3 exchanges to save tokens)
-    conversation_history = state.get("conversation_history", [])
-    if conversation_history:
-        recent_history = conversation_history[-3:]  # Last 3 Q&A pairs
-        conv_context = "Recent conversation:\n" + "\n".join([
-            f"Previous Q: {item['question']}\nPrevious SQL: {item['sql']}\nPrevious Answer: {item.get('answer', 'N/A')}"
-            for item in recent_history
-        ])
+    if state.get("error") and state.get("generation_messages"):
+        # Fix Mode: continue the previous generation's conversation, so the
+        # request shares its whole prompt prefix (and the provider's cache)
+        messages = state["generation_messages"] + [
+            AIMessage(content=state["candidate_sql"]),
+            HumanMessage(content=_sql_fix_user(
+                candidate_sql=state["candidate_sql"],
+                error=state["error"]
+            ))
+        ]
     else:
-        conv_context = "No previous conversation."
+        if state.get("error"):
+            # Fix Mode
+            instruction = _sql_fix_user(
+                candidate_sql=state["candidate_sql"],
+                error=state["error"]
+            )
+        else:
+            # Normal Mode
+            instruction = _sql_gen_user(user_question=question)
+        
+        # Static rules first, so every call shares the same cacheable prefix
+        messages = [
+            SystemMessage(content=SQL_GEN_SYSTEM_STATIC),
+            HumanMessage(content=_sql_gen_system_dynamic(
+                conversation_context=conv_context,
+                schema_context=schema,
+                few_shot_examples=few_shot_str,
+                instruction=instruction
+            ))
+        ]
     
-    if state.get("error"):
-        # Fix Mode
-        instruction = SQL_FIX_USER.format(
-            candidate_sql=state["candidate_sql"],
-            error=state["error"]
-        )
-    else:
-        # Normal Mode
-        instruction = SQL_GEN_USER.format(user_question=question)
-    
-    system_prompt = SQL_GEN_SYSTEM.format(
-        conversation_context=conv_context,
-        schema_context=schema,
-        few_shot_examples=few_shot_str,
-        instruction=instruction
-    )
+    # Clean up SQL (remove markdown code blocks and language prefixes). A
+    # retry of the fused call may still answer in its JSON format.
+    contents = await _generate_candidates(messages)
+    plans, parse_error = _parse_plans(contents)
+    if not plans:
+        return {**_parse_error_update(state, contents, parse_error), "generation_messages": messages}
+    sqls = [plan_sql for _, plan_sql in plans]
+    
+    # Check if LLM refused to generate SQL due to security policy. Only the
+    # greedy reply decides; a refusing sample is just dropped as an alternate
+    if "SECURITY_VIOLATION" in sqls[0]:
+        return {"candidate_sql": sqls[0], "alternate_sqls": [], "error": "Security Alert: Request involves data modification which is not allowed."}
+    
+    # Clear the previous attempt's error so the retry is executed
+    return {**_candidate_update(sqls), "generation_messages": messages, "error": None}
+
+async def plan_and_generate_node(state: AgentState):
+    """Selects tables and generates SQL in a single LLM call (small datasets only)."""
+    print("--- Planning & Generating SQL ---")
+    user_q = _user_question(state)
+    all_tables = _selectable_tables()
     
-    response = get_llm().invoke(system_prompt)
+    # Every table's schema is inlined, so there is no selection round-trip;
+    # build it while the few-shot examples are retrieved
+    schema_context, examples = await asyncio.gather(
+        asyncio.to_thread(get_schema_manager().get_formatted_schema_context, all_tables, max_tables=len(all_tables)),
+        asyncio.to_thread(get_memory_bank().retrieve_examples, user_q, k=2)
+    )
     
-    # Clean up SQL (remove markdown code blocks and language prefixes)
-    sql = response.content.replace("```sql", "").replace("```", "").strip()
+    messages = [
+        SystemMessage(content=SCHEMA_AND_SQL_STATIC),
+        HumanMessage(content=_schema_and_sql_dynamic(
+            conversation_context=_format_conversation(state.get("conversation_history", [])),
+            schema_context=schema_context,
+            few_shot_examples=_format_examples(examples),
+            user_question=user_q
+        ))
+    ]
+    contents = await _generate_candidates(messages)
+    plans, parse_error = _parse_plans(contents)
+    if not plans:
+        return {
+            "user_query": user_q,
+            "relevant_schema": schema_context,
+            "few_shot_examples": examples,
+            "generation_messages": messages,
+            **_parse_error_update(state, contents, parse_error)
+        }
+    tables, sql = plans[0]
+    if tables:
+        print(f"Selected tables: {', '.join(tables)}")
     
-    # Remove common language prefixes that LLM might add
-    for prefix in ["googlesql", "sql", "bigquery", "bq"]:
-        if sql.lower().startswith(prefix):
-            sql = sql[len(prefix):].strip()
-            break
+    update = {
+        "user_query": user_q,
+        # Retries go through generate_sql_node, which gets the full schema
+        "relevant_schema": schema_context,
+        "few_shot_examples": examples,
+        # A retry continues this conversation
+        "generation_messages": messages,
+        **_candidate_update([plan_sql for _, plan_sql in plans])
+    }
     
-    # Check if LLM refused to generate SQL due to security policy
+    # Check if LLM refused to generate SQL due to security policy (greedy reply only)
     if "SECURITY_VIOLATION" in sql:
-        return {"candidate_sql": sql, "error": "Security Alert: Request involves data modification which is not allowed."}
+        update["alternate_sqls"] = []
+        update["error"] = "Security Alert: Request involves data modification which is not allowed."
+    return update
+
+def _run_query(sql: str) -> List[Dict[str, Any]]:
+    """Runs the query on BigQuery and returns up to MAX_ROWS JSON-friendly rows (blocking)."""
+    # Retries in the fix loop often resubmit identical SQL, which the
+    # query cache answers for free
+    job_config = bigquery.QueryJobConfig(
+        maximum_bytes_billed=MAX_BYTES_BILLED,
+        use_query_cache=True
+    )
+    query_job = get_bq_client().query(sql, job_config=job_config)
+    # Only the first MAX_ROWS rows are downloaded, whatever the query returns
+    rows = query_job.result(max_results=MAX_ROWS)
+    if rows.total_rows and rows.total_rows > MAX_ROWS:
+        print(f"⚠️ Truncated results at {MAX_ROWS} rows")
+    
+    # Convert non-serializable types (datetime, date) to str for LLM.
+    # Only these columns can hold them, so the other cells aren't inspected.
+    # REPEATED columns hold lists (never NULL, possibly empty).
+    date_fields = [field for field in rows.schema if field.field_type in DATE_FIELD_TYPES]
+    date_cols = [field.name for field in date_fields if field.mode != "REPEATED"]
+    repeated_date_cols = [field.name for field in date_fields if field.mode == "REPEATED"]
     
-    return {"candidate_sql": sql}
+    results = []
+    for row in rows:
+        row = dict(row)
+        for k in date_cols:
+            if row[k] is not None:
+                row[k] = row[k].isoformat()
+        for k in repeated_date_cols:
+            row[k] = [value.isoformat() for value in row[k]]
+        results.append(row)
+    return results
+
+def _dry_run(sql: str) -> str:
+    """Asks BigQuery to plan the query without running it; returns the error, or None if valid (blocking)."""
+    job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+    try:
+        get_bq_client().query(sql, job_config=job_config)
+    except Exception as e:
+        return str(e)
+    return None
 
-def validate_and_execute_node(state: AgentState):
+async def validate_and_execute_node(state: AgentState):
     """Validates safety and executes against BigQuery."""
     print("--- Executing SQL ---")
-    sql = state["candidate_sql"]
     
-    # 1. Safety Check
-    try:
-        validate_sql_safety(sql)
-    except SQLSecurityError as e:
-        return {"error": str(e), "retry_count": state.get("retry_count", 0) + 1, "query_result": []}
-        
-    # 2. Execution
-    try:
-        # Add LIMIT to query if not present to prevent huge result sets
-        sql_upper = sql.upper()
-        if 'LIMIT' not in sql_upper:
+    # 1. Safety Check (every candidate; unsafe alternates are simply dropped)
+    candidates = []
+    checked = []
+    security_error = None
+    for sql in [state["candidate_sql"]] + state.get("alternate_sqls", []):
+        try:
+            checked.append(validate_sql_safety(sql))
+            candidates.append(sql)
+        except SQLSecurityError as e:
+            security_error = security_error or str(e)
+    if not candidates:
+        return {"error": security_error, "retry_count": state.get("retry_count", 0) + 1, "query_result": []}
+    
+    # Add LIMIT to query if not present to prevent huge result sets
+    runnable = []
+    for sql, result in zip(candidates, checked):
+        if not _LIMIT_RE.search(sql):
             # Add LIMIT 100 to prevent massive results
-            sql = sql.rstrip(';').rstrip() + ' LIMIT 100'
-            print(f"⚠️ Added LIMIT 100 to query (no LIMIT clause found)")
-        
-        query_job = get_bq_client().query(sql)
-        
-        # Fetch results with a hard limit
-        MAX_ROWS = 100
-        results = []
-        for i, row in enumerate(query_job):
-            if i >= MAX_ROWS:
-                print(f"⚠️ Truncated results at {MAX_ROWS} rows")
-                break
-            results.append(dict(row))
-        
-        # Convert non-serializable types (datetime, date) to str for LLM
-        for row in results:
-            for k, v in row.items():
-                if hasattr(v, 'isoformat'):
-                    row[k] = v.isoformat()
-                    
-        return {"query_result": results, "error": None}
-        
-    except Exception as e:
-        return {"error": str(e), "retry_count": state.get("retry_count", 0) + 1, "query_result": []}
+            runnable.append(result.stripped + f' LIMIT {MAX_ROWS}')
+            print(f"⚠️ Added LIMIT {MAX_ROWS} to query (no LIMIT clause found)")
+        else:
+            runnable.append(sql)
+    
+    # 2. With several candidates, dry-run them in parallel (free, and much
+    # faster than executing) and keep those BigQuery accepts, greedy one first
+    if len(runnable) > 1:
+        dry_run_errors = await asyncio.gather(*(asyncio.to_thread(_dry_run, sql) for sql in runnable))
+        passed = [i for i, err in enumerate(dry_run_errors) if err is None]
+        if not passed:
+            return {"error": dry_run_errors[0], "retry_count": state.get("retry_count", 0) + 1, "query_result": []}
+        if passed[0] != 0:
+            print("Using alternate SQL candidate (greedy candidate failed dry run)")
+        candidates = [candidates[i] for i in passed]
+        runnable = [runnable[i] for i in passed]
+    
+    # 3. Execution, falling back to the next candidate before regenerating
+    error = None
+    for sql, query in zip(candidates, runnable):
+        try:
+            # The BigQuery client blocks; run it in a worker thread so the event
+            # loop stays free for other runs (e.g. concurrent Streamlit sessions)
+            results = await asyncio.to_thread(_run_query, query)
+            return {"candidate_sql": sql, "alternate_sqls": [], "query_result": results, "error": None}
+        except Exception as e:
+            error = error or str(e)
+    
+    return {"error": error, "retry_count": state.get("retry_count", 0) + 1, "query_result": []}
 
-def synthesize_answer_node(state: AgentState):
-    """Formats the answer."""
+def _encode_result(rows: List[Dict[str, Any]]) -> Tuple[str, bool]:
+    """
+    Encodes rows as compact JSON, at most MAX_RESULT_CHARS long. Encoding
+    stops as soon as the budget is used, so a wide result is never fully
+    serialized just to be cut. Returns the text and whether it was truncated.
+    """
+    parts = []
+    size = 0
+    for chunk in _RESULT_ENCODER.iterencode(rows):
+        parts.append(chunk)
+        size += len(chunk)
+        if size > MAX_RESULT_CHARS:
+            return "".join(parts)[:MAX_RESULT_CHARS], True
+    return "".join(parts), False
+
+async def synthesize_answer_node(state: AgentState):
+    """Formats the answer, streaming tokens to callers using stream_mode="messages"."""
     print("--- Synthesizing ---")
     
     if state.get("error"):
-        prompt = ERROR_RESPONSE_PROMPT.format(
+        prompt = _error_response_prompt(
             user_question=state["user_query"],
             error=state["error"]
         )
@@ -212,22 +525,25 @@ def synthesize_answer_node(state: AgentState):
         else:
             result_note = ""
         
-        # Convert to string and truncate if still too long
-        result_str = str(query_result)
-        MAX_RESULT_CHARS = 2000  # Limit to ~500 tokens
-        if len(result_str) > MAX_RESULT_CHARS:
-            result_str = result_str[:MAX_RESULT_CHARS] + f"...\n(truncated, total {len(query_result)} rows)"
+        # Convert to JSON, stopping once it is too long
+        result_str, truncated = _encode_result(query_result)
+        if truncated:
+            result_str += f"...\n(truncated, total {len(query_result)} rows)"
         
         result_str += result_note
         
-        prompt = ANSWER_SYNTHESIS_PROMPT.format(
+        prompt = _answer_synthesis_prompt(
             user_question=state["user_query"],
             candidate_sql=state["candidate_sql"],
             query_result=result_str
         )
         
-    response = get_llm().invoke(prompt)
-    return {"final_answer": response.content}
+    # Stream so the CLI can print the answer as it is generated; the full
+    # text is still accumulated for the state
+    chunks = []
+    async for chunk in get_llm().astream(prompt):
+        chunks.append(chunk.content)
+    return {"final_answer": "".join(chunks)}
 
 def human_feedback_node(state: AgentState):
     """
@@ -241,19 +557,41 @@ def human_feedback_node(state: AgentState):
     return {"user_feedback": "approved"} 
 
 def save_knowledge_node(state: AgentState):
-    """Saves the successful query to memory bank."""
+    """
+    Queues the successful query for a batched save to the memory bank and
+    appends this turn to the (bounded) conversation history.
+    """
     print("--- Saving Knowledge ---")
     if not state.get("error"):
-        get_memory_bank().save_example(state["user_query"], state["candidate_sql"])
-    return {}
+        get_memory_bank().queue_example(state["user_query"], state["candidate_sql"])
+    
+    # State is serialized as plain lists, so rebuild the ring buffer here;
+    # the history stays at MAX_CONVERSATION_HISTORY turns however long the session
+    history = deque(state.get("conversation_history") or [], maxlen=MAX_CONVERSATION_HISTORY)
+    history.append({
+        "question": state["user_query"],
+        "sql": state.get("candidate_sql", ""),
+        "answer": state.get("final_answer", "")
+    })
+    # The history carries everything later turns need; drop the rows and the
+    # inlined schema (also in the generation messages) so callers holding the
+    # final state don't keep them alive
+    return {"conversation_history": list(history), "query_result": [], "relevant_schema": "", "generation_messages": []}
 
 # --- EDGES ---
 
-def should_execute_sql(state: AgentState) -> Literal["execute_sql", "synthesize_answer"]:
-    """Decide whether to execute SQL or skip to synthesis if there's already an error."""
+def route_question(state: AgentState) -> Literal["plan_and_generate", "select_schema"]:
+    """Use the single-call path unless the schema is too large to inline."""
+    if len(get_schema_manager().get_all_tables()) > FUSED_MAX_TABLES:
+        return "select_schema"
+    return "plan_and_generate"
+
+def should_execute_sql(state: AgentState) -> Literal["execute_sql", "generate_sql", "synthesize_answer"]:
+    """Decide whether to execute SQL, or handle an error detected while generating it."""
     if state.get("error"):
-        # Error already detected (e.g., from LLM refusing to generate SQL)
-        return "synthesize_answer"
+        # A refusal ("Security Alert") goes straight to synthesis; anything
+        # else (e.g. an unparseable reply) is retried like a failed query
+        return should_retry(state)
     return "execute_sql"
 
 def should_retry(state: AgentState) -> Literal["generate_sql", "synthesize_answer"]:
@@ -279,16 +617,22 @@ def should_retry(state: AgentState) -> Literal["generate_sql", "synthesize_answe
 def build_graph():
     workflow = StateGraph(AgentState)
     
+    workflow.add_node("plan_and_generate", plan_and_generate_node)
     workflow.add_node("select_schema", select_schema_node)
     workflow.add_node("generate_sql", generate_sql_node)
     workflow.add_node("execute_sql", validate_and_execute_node)
     workflow.add_node("synthesize_answer", synthesize_answer_node)
     workflow.add_node("save_knowledge", save_knowledge_node)
     
-    workflow.set_entry_point("select_schema")
+    workflow.set_conditional_entry_point(route_question)
     
     workflow.add_edge("select_schema", "generate_sql")
     
+    workflow.add_conditional_edges(
+        "plan_and_generate",
+        should_execute_sql,
+    )
+    
     workflow.add_conditional_edges(
         "generate_sql",
         should_execute_sql,
@@ -302,4 +646,6 @@ def build_graph():
     workflow.add_edge("synthesize_answer", "save_knowledge")
     workflow.add_edge("save_knowledge", END)
     
+    # No checkpointer: callers pass conversation_history in and get it back
+    # with the final state, so nothing outlives a run inside the graph
     return workflow.compile()
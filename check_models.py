@@ -1,7 +1,28 @@
 from google.cloud import aiplatform
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from langchain_google_vertexai import ChatVertexAI
 
+# Probes are independent network round-trips, so they run concurrently
+MAX_WORKERS = 16
+# Seconds before a probe gives up, so dead endpoints don't stall workers
+PROBE_TIMEOUT = 5
+
+def _probe(location, model_name, project_id):
+    """Invokes the model once; returns None on success, else a short failure label."""
+    try:
+        # We set max_retries=0 to fail fast
+        llm = ChatVertexAI(model=model_name, location=location, project=project_id,
+                           max_retries=0, timeout=PROBE_TIMEOUT)
+        llm.invoke("Hello")
+        return None
+    except Exception as e:
+        if "404" in str(e):
+            return "❌ 404"
+        elif "403" in str(e):
+            return "❌ 403"
+        return f"⚠️ {str(e)[:10]}..."
+
 def list_models():
     project_id = os.getenv("GOOGLE_CLOUD_PROJECT") or "viona-opendata-proj"
     # Common regions for Vertex AI
@@ -22,36 +43,30 @@ def list_models():
         "text-unicorn"
     ]
     
+    # Each probe passes its own location, so one init covers every region
+    aiplatform.init(project=project_id)
+    
     successes = []
+    tasks = [(location, model_name) for location in regions for model_name in known_models]
+    print(f"Probing {len(tasks)} region/model pairs...")
     
-    for location in regions:
-        print(f"\n--- Checking Region: {location} ---")
-        try:
-            aiplatform.init(project=project_id, location=location)
-            # Try to invoke
-            for model_name in known_models:
-                try:
-                    print(f"  Probing {model_name}...", end=" ", flush=True)
-                    llm = ChatVertexAI(model=model_name, location=location, project=project_id, max_retries=0)
-                    # We set max_retries=0 to fail fast
-                    llm.invoke("Hello")
-                    print(f"✅ FOUND!")
-                    successes.append(f"{location}: {model_name}")
-                except Exception as e:
-                    if "404" in str(e):
-                        print("❌ 404", end=" ")
-                    elif "403" in str(e):
-                         print("❌ 403", end=" ")
-                    else:
-                        print(f"⚠️ {str(e)[:10]}...", end=" ")
-                    print("")
-        except Exception as e:
-            print(f"  Failed to init region: {e}")
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {executor.submit(_probe, location, model_name, project_id): (location, model_name)
+                   for location, model_name in tasks}
+        for future in as_completed(futures):
+            location, model_name = futures[future]
+            failure = future.result()
+            if failure is None:
+                print(f"  {location}: {model_name} ✅ FOUND!")
+                successes.append((location, model_name))
+            else:
+                print(f"  {location}: {model_name} {failure}")
 
     print("\n\n=== AVAILABLE MODELS ===")
     if successes:
-        for s in successes:
-            print(f" - {s}")
+        # Completion order is arbitrary; report in the original region/model order
+        for location, model_name in sorted(successes, key=tasks.index):
+            print(f" - {location}: {model_name}")
     else:
         print("No models found.")
 
@@ -1,29 +1,119 @@
+import re
 import sqlite3
 import json
+import threading
 from datetime import datetime
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 from contextlib import contextmanager
 
+try:
+    import zstandard
+except ImportError:  # Optional: without zstandard schemas are stored as plain JSON text
+    zstandard = None
+
+try:
+    import orjson
+except ImportError:  # Optional: several times faster than json for the same data
+    orjson = None
+
+if orjson is not None:
+    _json_loads = orjson.loads
+    def _json_dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+else:
+    _json_loads = json.loads
+    def _json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj).encode()
+
 DATABASE_FILE = "text2sql.db"
 
+# Applied once per connection. WAL lets readers proceed during writes and,
+# with synchronous=NORMAL, avoids an fsync on every commit.
+CONNECTION_PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-65536",
+]
+
+# Full-text index over training examples, kept in sync by triggers. It is an
+# external-content table, so the text itself is only stored once.
+TRAINING_FTS_STATEMENTS = [
+    """CREATE VIRTUAL TABLE training_fts USING fts5(
+        question, sql, content='training_examples', content_rowid='id'
+    )""",
+    """CREATE TRIGGER training_fts_ai AFTER INSERT ON training_examples BEGIN
+        INSERT INTO training_fts(rowid, question, sql) VALUES (new.id, new.question, new.sql);
+    END""",
+    """CREATE TRIGGER training_fts_ad AFTER DELETE ON training_examples BEGIN
+        INSERT INTO training_fts(training_fts, rowid, question, sql) VALUES ('delete', old.id, old.question, old.sql);
+    END""",
+    """CREATE TRIGGER training_fts_au AFTER UPDATE OF question, sql ON training_examples BEGIN
+        INSERT INTO training_fts(training_fts, rowid, question, sql) VALUES ('delete', old.id, old.question, old.sql);
+        INSERT INTO training_fts(rowid, question, sql) VALUES (new.id, new.question, new.sql);
+    END""",
+    # Index examples saved before the table existed
+    "INSERT INTO training_fts(training_fts) VALUES ('rebuild')",
+]
+
+_WORD_RE = re.compile(r"\w+")
+
+# Schema JSON is highly repetitive (field names, types, modes) and compresses well
+SCHEMA_ZSTD_LEVEL = 6
+
 class DatabaseManager:
+    # Shared managers by database path, see instance()
+    _instances: Dict[str, "DatabaseManager"] = {}
+    _instances_lock = threading.Lock()
+    
+    @classmethod
+    def instance(cls, db_path: str = DATABASE_FILE) -> "DatabaseManager":
+        """
+        Returns the process-wide manager for db_path, creating it on first use,
+        so every component shares one connection and its caches.
+        """
+        with cls._instances_lock:
+            if db_path not in cls._instances:
+                cls._instances[db_path] = cls(db_path)
+            return cls._instances[db_path]
+    
     def __init__(self, db_path: str = DATABASE_FILE):
         self.db_path = db_path
+        
+        # One connection for the manager's lifetime, so connect/PRAGMA setup is
+        # paid once and sqlite3's prepared-statement cache stays warm.
+        # isolation_level=None: transactions are managed by get_connection.
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        for pragma in CONNECTION_PRAGMAS:
+            self._conn.execute(pragma)
+        # The connection is shared across threads (e.g. asyncio.to_thread), so
+        # every use is serialized
+        self._lock = threading.RLock()
+        # Decoded schemas by table name; every schema write goes through save_schema
+        self._schemas: Dict[str, Any] = {}
+        
         self._initialize_database()
     
     @contextmanager
     def get_connection(self):
-        """Context manager for database connections."""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        try:
-            yield conn
-            conn.commit()
-        except Exception:
-            conn.rollback()
-            raise
-        finally:
-            conn.close()
+        """Context manager yielding the shared connection inside a transaction."""
+        with self._lock:
+            if self._conn.in_transaction:
+                # Nested use joins the enclosing transaction
+                yield self._conn
+                return
+            self._conn.execute("BEGIN")
+            try:
+                yield self._conn
+                self._conn.execute("COMMIT")
+            except BaseException:
+                # BaseException too (KeyboardInterrupt, cancellation): left open,
+                # the shared transaction would swallow every later write
+                if self._conn.in_transaction:
+                    self._conn.execute("ROLLBACK")
+                raise
     
     def _initialize_database(self):
         """Create tables if they don't exist."""
@@ -35,7 +125,8 @@ class DatabaseManager:
                 CREATE TABLE IF NOT EXISTS schema_cache (
                     table_name TEXT PRIMARY KEY,
                     schema_json TEXT NOT NULL,
-                    last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    schema_zstd BLOB
                 )
             """)
             
@@ -47,10 +138,21 @@ class DatabaseManager:
                     sql TEXT NOT NULL,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     success_count INTEGER DEFAULT 0,
+                    embedding BLOB,
                     UNIQUE(question, sql)
                 )
             """)
             
+            # Databases created before embeddings were stored lack the column
+            columns = {row['name'] for row in cursor.execute("PRAGMA table_info(training_examples)")}
+            if 'embedding' not in columns:
+                cursor.execute("ALTER TABLE training_examples ADD COLUMN embedding BLOB")
+            
+            # Compressed schemas; rows written without zstandard keep schema_json only
+            columns = {row['name'] for row in cursor.execute("PRAGMA table_info(schema_cache)")}
+            if 'schema_zstd' not in columns:
+                cursor.execute("ALTER TABLE schema_cache ADD COLUMN schema_zstd BLOB")
+            
             # Query history table
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS query_history (
@@ -63,6 +165,38 @@ class DatabaseManager:
                 )
             """)
             
+            # Indexes for the ORDER BY ... LIMIT lookups; (question, sql) is
+            # already covered by the UNIQUE constraint's index
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_train_created ON training_examples(created_at DESC)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_history_ts ON query_history(timestamp DESC)")
+            
+            # Lexical search over examples, used when similarity search is unavailable
+            self.fts_enabled = True
+            exists = cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'training_fts'"
+            ).fetchone()
+            if not exists:
+                try:
+                    cursor.execute("SAVEPOINT training_fts")
+                    for statement in TRAINING_FTS_STATEMENTS:
+                        cursor.execute(statement)
+                    cursor.execute("RELEASE training_fts")
+                except sqlite3.OperationalError:
+                    # SQLite built without FTS5
+                    cursor.execute("ROLLBACK TO training_fts")
+                    cursor.execute("RELEASE training_fts")
+                    self.fts_enabled = False
+            
+            # Embedding cache: avoids re-embedding identical texts across sessions
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS embedding_cache (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    vec BLOB NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            
             # Metadata table for storing misc key-value pairs
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS metadata (
@@ -74,55 +208,182 @@ class DatabaseManager:
     
     # --- Schema Cache Methods ---
     
+    @staticmethod
+    def _encode_schema(schema_data: Any) -> Tuple[str, Optional[bytes]]:
+        """Returns the (schema_json, schema_zstd) column values for a schema."""
+        data = _json_dumps(schema_data)
+        if zstandard is None:
+            return data.decode(), None
+        return "", zstandard.compress(data, SCHEMA_ZSTD_LEVEL)
+    
+    @staticmethod
+    def _decode_schema(row: sqlite3.Row) -> Optional[Any]:
+        """Decodes a schema_cache row; None if it is compressed and zstandard is missing."""
+        if row['schema_zstd'] is None:
+            return _json_loads(row['schema_json'])
+        if zstandard is None:
+            return None  # Treated as a cache miss, so the schema is fetched again
+        return _json_loads(zstandard.decompress(row['schema_zstd']))
+    
     def save_schema(self, table_name: str, schema_data: Any):
         """Save or update schema for a table."""
+        self.save_schemas([(table_name, schema_data)])
+    
+    def save_schemas(self, schemas: List[Tuple[str, Any]]):
+        """Save or update schemas for several tables in one transaction."""
+        now = datetime.now()
+        rows = [(table_name, *self._encode_schema(schema_data), now) for table_name, schema_data in schemas]
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                INSERT OR REPLACE INTO schema_cache (table_name, schema_json, last_updated)
-                VALUES (?, ?, ?)
-            """, (table_name, json.dumps(schema_data), datetime.now()))
+            cursor.executemany("""
+                INSERT OR REPLACE INTO schema_cache (table_name, schema_json, schema_zstd, last_updated)
+                VALUES (?, ?, ?, ?)
+            """, rows)
+            self._schemas.update(schemas)
     
     def get_schema(self, table_name: str) -> Optional[Any]:
         """Retrieve schema for a table."""
+        with self._lock:
+            if table_name in self._schemas:
+                return self._schemas[table_name]
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT schema_json FROM schema_cache WHERE table_name = ?", (table_name,))
+            cursor.execute("SELECT schema_json, schema_zstd FROM schema_cache WHERE table_name = ?", (table_name,))
             row = cursor.fetchone()
-            return json.loads(row['schema_json']) if row else None
+            schema = self._decode_schema(row) if row else None
+            if schema is not None:
+                self._schemas[table_name] = schema
+            return schema
     
     def get_all_schemas(self) -> Dict[str, Any]:
         """Retrieve all cached schemas."""
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT table_name, schema_json FROM schema_cache")
-            return {row['table_name']: json.loads(row['schema_json']) for row in cursor.fetchall()}
+            cursor.execute("SELECT table_name, schema_json, schema_zstd FROM schema_cache")
+            schemas = {}
+            for row in cursor.fetchall():
+                schema = self._schemas.get(row['table_name'])
+                if schema is None:
+                    schema = self._decode_schema(row)
+                if schema is not None:
+                    schemas[row['table_name']] = self._schemas[row['table_name']] = schema
+            return schemas
     
     # --- Training Examples Methods ---
     
-    def save_training_example(self, question: str, sql: str):
-        """Save a training example (question-SQL pair)."""
+    def save_training_example(self, question: str, sql: str, embedding: bytes = None):
+        """Save a training example (question-SQL pair) with an optional question embedding."""
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
-                INSERT OR IGNORE INTO training_examples (question, sql)
-                VALUES (?, ?)
-            """, (question, sql))
+                INSERT OR IGNORE INTO training_examples (question, sql, embedding)
+                VALUES (?, ?, ?)
+            """, (question, sql, embedding))
     
-    def get_training_examples(self, limit: int = None) -> List[Dict[str, Any]]:
-        """Retrieve training examples, optionally limited."""
+    def save_training_examples(self, examples: List[Tuple[str, str, Optional[bytes]]]):
+        """Save several (question, sql, embedding) training examples in one transaction."""
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            query = "SELECT id, question, sql, created_at, success_count FROM training_examples ORDER BY created_at DESC"
+            cursor.executemany("""
+                INSERT OR IGNORE INTO training_examples (question, sql, embedding)
+                VALUES (?, ?, ?)
+            """, examples)
+    
+    @staticmethod
+    def _training_search_filter(search: Optional[str]) -> Tuple[str, List[Any]]:
+        """WHERE clause and parameters matching examples whose question or SQL contains search."""
+        if not search:
+            return "", []
+        pattern = "%" + search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        return " WHERE question LIKE ? ESCAPE '\\' OR sql LIKE ? ESCAPE '\\'", [pattern, pattern]
+    
+    def get_training_examples(self, limit: int = None, offset: int = 0, search: str = None) -> List[Dict[str, Any]]:
+        """Retrieve training examples, newest first, optionally paged and filtered by a substring."""
+        where, params = self._training_search_filter(search)
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            query = f"SELECT id, question, sql, created_at, success_count FROM training_examples{where} ORDER BY created_at DESC"
             if limit:
-                query += f" LIMIT {limit}"
-            cursor.execute(query)
+                cursor.execute(query + " LIMIT ? OFFSET ?", params + [limit, offset])
+            else:
+                cursor.execute(query, params)
             return [dict(row) for row in cursor.fetchall()]
     
+    def count_training_examples(self, search: str = None) -> int:
+        """Count training examples, optionally only those matching a substring."""
+        where, params = self._training_search_filter(search)
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT COUNT(*) FROM training_examples{where}", params)
+            return cursor.fetchone()[0]
+    
     def get_recent_training_examples(self, k: int = 3) -> List[Dict[str, str]]:
         """Get the k most recent training examples."""
-        examples = self.get_training_examples(limit=k)
-        return [{"question": ex["question"], "sql": ex["sql"]} for ex in examples]
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT question, sql FROM training_examples ORDER BY created_at DESC LIMIT ?", (k,))
+            return [{"question": row['question'], "sql": row['sql']} for row in cursor.fetchall()]
+    
+    def search_training_examples(self, text: str, k: int = 3) -> List[Dict[str, str]]:
+        """Get the k examples that best match the words in text (BM25, question weighted 2x)."""
+        words = _WORD_RE.findall(text.lower())
+        if not words or not self.fts_enabled:
+            return []
+        # Quoted terms, so user text can't inject FTS5 query syntax
+        match = " OR ".join(f'"{word}"' for word in dict.fromkeys(words))
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT question, sql FROM training_fts
+                WHERE training_fts MATCH ?
+                ORDER BY bm25(training_fts, 2.0, 1.0)
+                LIMIT ?
+            """, (match, k))
+            return [{"question": row['question'], "sql": row['sql']} for row in cursor.fetchall()]
+    
+    def get_training_examples_by_ids(self, ids: List[int]) -> Dict[int, Dict[str, str]]:
+        """Retrieve question-SQL pairs for the given IDs, keyed by ID."""
+        if not ids:
+            return {}
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            placeholders = ",".join("?" * len(ids))
+            cursor.execute(f"SELECT id, question, sql FROM training_examples WHERE id IN ({placeholders})", list(ids))
+            return {row['id']: {"question": row['question'], "sql": row['sql']} for row in cursor.fetchall()}
+    
+    def get_training_embeddings(self, after_id: int = 0) -> List[Tuple[int, bytes]]:
+        """Retrieve (id, embedding) pairs for examples with an ID greater than after_id."""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT id, embedding FROM training_examples
+                WHERE id > ? AND embedding IS NOT NULL
+                ORDER BY id
+            """, (after_id,))
+            return [(row['id'], row['embedding']) for row in cursor.fetchall()]
+    
+    def count_training_embeddings(self, max_id: int) -> int:
+        """Count examples with an embedding and an ID of at most max_id."""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM training_examples WHERE id <= ? AND embedding IS NOT NULL", (max_id,))
+            return cursor.fetchone()[0]
+    
+    def get_training_examples_without_embedding(self) -> List[Tuple[int, str]]:
+        """Retrieve (id, question) pairs for examples that have not been embedded yet."""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, question FROM training_examples WHERE embedding IS NULL ORDER BY id")
+            return [(row['id'], row['question']) for row in cursor.fetchall()]
+    
+    def set_training_embeddings(self, embeddings: List[Tuple[int, bytes]]):
+        """Store question embeddings for existing examples, given (id, embedding) pairs."""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                "UPDATE training_examples SET embedding = ? WHERE id = ?",
+                [(embedding, example_id) for example_id, embedding in embeddings]
+            )
     
     def delete_training_example(self, example_id: int):
         """Delete a training example by ID."""
@@ -165,12 +426,40 @@ class DatabaseManager:
             """, (limit,))
             return [dict(row) for row in cursor.fetchall()]
     
+    def count_query_history(self) -> int:
+        """Count query history entries."""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM query_history")
+            return cursor.fetchone()[0]
+    
     def clear_query_history(self):
         """Clear all query history."""
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM query_history")
     
+    # --- Embedding Cache Methods ---
+    
+    def get_cached_embeddings(self, keys: List[str]) -> Dict[str, bytes]:
+        """Retrieve cached embedding vectors for the given keys, keyed by key."""
+        if not keys:
+            return {}
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            placeholders = ",".join("?" * len(keys))
+            cursor.execute(f"SELECT key, vec FROM embedding_cache WHERE key IN ({placeholders})", list(keys))
+            return {row['key']: row['vec'] for row in cursor.fetchall()}
+    
+    def save_cached_embeddings(self, entries: List[Tuple[str, str, bytes]]):
+        """Store (key, model, vec) embedding cache entries."""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany("""
+                INSERT OR REPLACE INTO embedding_cache (key, model, vec, updated_at)
+                VALUES (?, ?, ?, ?)
+            """, [(key, model, vec, datetime.now()) for key, model, vec in entries])
+    
     # --- Metadata Methods ---
     
     def set_metadata(self, key: str, value: Any):
@@ -180,7 +469,7 @@ class DatabaseManager:
             cursor.execute("""
                 INSERT OR REPLACE INTO metadata (key, value, updated_at)
                 VALUES (?, ?, ?)
-            """, (key, json.dumps(value), datetime.now()))
+            """, (key, _json_dumps(value).decode(), datetime.now()))
     
     def get_metadata(self, key: str) -> Optional[Any]:
         """Retrieve a metadata value."""
@@ -188,7 +477,7 @@ class DatabaseManager:
             cursor = conn.cursor()
             cursor.execute("SELECT value FROM metadata WHERE key = ?", (key,))
             row = cursor.fetchone()
-            return json.loads(row['value']) if row else None
+            return _json_loads(row['value']) if row else None
     
     # --- Migration Utilities ---
     
@@ -206,23 +495,26 @@ class DatabaseManager:
             return
         
         if table_type == 'schema':
-            # Migrate schema_cache.json
+            # Migrate schema_cache.json: all schemas in one executemany, and
+            # the table list, in a single transaction
             with open(json_file, 'r') as f:
-                data = json.load(f)
-                for key, value in data.items():
-                    if key.startswith('schema_'):
-                        table_name = key.replace('schema_', '')
-                        self.save_schema(table_name, value)
-                    elif key == 'tables':
-                        self.set_metadata('tables', value)
+                data = _json_loads(f.read())
+            schemas = [(key.replace('schema_', ''), value) for key, value in data.items() if key.startswith('schema_')]
+            with self.get_connection():
+                self.save_schemas(schemas)
+                if 'tables' in data:
+                    self.set_metadata('tables', data['tables'])
         
         elif table_type == 'training':
-            # Migrate training_data.jsonl
+            # Migrate training_data.jsonl in a single batch; embeddings are
+            # computed later, in one request, when the MemoryBank index loads
+            examples = []
             with open(json_file, 'r') as f:
                 for line in f:
                     if line.strip():
-                        entry = json.loads(line)
-                        self.save_training_example(entry['question'], entry['sql'])
+                        entry = _json_loads(line)
+                        examples.append((entry['question'], entry['sql'], None))
+            self.save_training_examples(examples)
 
 if __name__ == "__main__":
     # Test the database
@@ -1,15 +1,65 @@
 import dotenv
+import asyncio
 import argparse
 from agent import build_graph
 
 dotenv.load_dotenv()
 
+async def stream_response(graph, initial_state, verbose=False):
+    """
+    Streams one turn through the graph, printing the answer tokens as they
+    arrive. Returns the final answer and the updated conversation history.
+    """
+    final_response = ""
+    conversation_history = initial_state.get("conversation_history", [])
+    answer_started = False
+    
+    async for mode, payload in graph.astream(initial_state, stream_mode=["updates", "messages"]):
+        if mode == "messages":
+            # Token chunks from LLM calls; only the synthesized answer is shown
+            chunk, metadata = payload
+            if metadata.get("langgraph_node") == "synthesize_answer" and chunk.content:
+                if not answer_started:
+                    print("\n\nAgent Response:")
+                    answer_started = True
+                print(chunk.content, end="", flush=True)
+            continue
+        
+        for node_name, state_update in payload.items():
+            if not state_update:
+                continue
+                
+            if verbose:
+                # One write per node update rather than one per field
+                lines = [f"\n\n[Node: {node_name}]"]
+                if "candidate_sql" in state_update:
+                    lines.append(f"SQL: {state_update['candidate_sql']}")
+                if state_update.get("error"):
+                    lines.append(f"Error: {state_update['error']}")
+                print("\n".join(lines))
+            
+            final_response = state_update.get("final_answer", final_response)
+            conversation_history = state_update.get("conversation_history", conversation_history)
+    
+    if answer_started:
+        print()
+    else:
+        # The model did not stream; print the whole answer at once
+        print("\n\nAgent Response:")
+        print(final_response)
+    
+    return final_response, conversation_history
+
 def main():
     parser = argparse.ArgumentParser(description="Text2SQL Agent CLI")
     parser.add_argument("--verbose", action="store_true", help="Print debug info")
     args = parser.parse_args()
 
     graph = build_graph()
+    # One loop for the whole session: the agent's async LLM clients are bound to it
+    loop = asyncio.new_event_loop()
+    # Carried across turns so follow-up questions have context
+    conversation_history = []
     
     print("Welcome to the Text2SQL Agent! (Type 'quit' to exit)")
     print("Dataset: bigquery-public-data.thelook_ecommerce")
@@ -26,29 +76,15 @@ def main():
                 "messages": [("user", user_input)],
                 "retry_count": 0,
                 "error": None,
-                "query_result": []
+                "query_result": [],
+                "conversation_history": conversation_history
             }
             
-            final_response = ""
             print("Agent: Thinking...", end="", flush=True)
             
-            for event in graph.stream(initial_state):
-                for node_name, state_update in event.items():
-                    if state_update is None:
-                        continue
-                        
-                    if args.verbose:
-                        print(f"\n\n[Node: {node_name}]")
-                        if "candidate_sql" in state_update:
-                            print(f"SQL: {state_update['candidate_sql']}")
-                        if "error" in state_update and state_update["error"]:
-                            print(f"Error: {state_update['error']}")
-                    
-                    if "final_answer" in state_update:
-                        final_response = state_update["final_answer"]
-            
-            print("\n\nAgent Response:")
-            print(final_response)
+            _, conversation_history = loop.run_until_complete(
+                stream_response(graph, initial_state, verbose=args.verbose)
+            )
             
         except KeyboardInterrupt:
             break
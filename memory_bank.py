@@ -1,16 +1,79 @@
 import os
-from typing import List, Dict
+import math
+import atexit
+import hashlib
+import threading
+from functools import lru_cache
+from typing import List, Dict, Tuple
+
+import numpy as np
+from langchain_google_vertexai import VertexAIEmbeddings
+
 from db_manager import DatabaseManager
 
+try:
+    import faiss
+except ImportError:  # Optional: without faiss every search is a brute-force scan
+    faiss = None
+
+EMBEDDING_MODEL = "text-embedding-004"
+
+# IVF needs enough vectors to train its coarse quantizer; below this size a
+# brute-force scan is just as fast, so the index is only built past it.
+IVF_MIN_TRAIN_SIZE = 256
+IVF_NLIST = 64
+IVF_NPROBE = 8
+# faiss wants ~39 training points per list; fewer lists on a small bank keeps recall up
+IVF_POINTS_PER_LIST = 39
+
+def _target_nlist(n: int) -> int:
+    """Number of IVF lists for n vectors: about sqrt(n), capped by IVF_NLIST and the training points available."""
+    return max(1, min(IVF_NLIST, math.isqrt(n), n // IVF_POINTS_PER_LIST))
+
+# The index file is rewritten once this many examples were added or removed
+# since the last write, and at exit; it is only a cache of the database
+INDEX_PERSIST_BATCH = 64
+
+# Queued examples are saved together once this many pile up, or after this
+# many seconds without a new one (one embedding request per batch)
+FLUSH_BATCH_SIZE = 32
+FLUSH_IDLE_SECONDS = 5.0
+
 class MemoryBank:
+    # The legacy JSONL file is looked for once per process, not per instance
+    _migration_checked = False
+    
     def __init__(self):
-        self.db = DatabaseManager()
-        
+        self.db = DatabaseManager.instance()
+        self.index_file = os.path.splitext(self.db.db_path)[0] + ".faiss"
+
+        # Lazily created embedding client and search index
+        self._embeddings = None
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._index = None  # faiss IVF index, once there are enough examples
+        self._ids = np.empty(0, dtype=np.int64)  # brute-force fallback
+        self._vecs = None
+        self._max_indexed_id = 0
+        self._unsaved_changes = 0  # Index changes not yet written to index_file
+        # In-process layer over the SQLite embedding cache
+        self.embed_with_cache = lru_cache(maxsize=1024)(self.embed_with_cache)
+
+        # Examples queued by queue_example, waiting for a batched save
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._flush_timer = None
+        atexit.register(self.flush_pending)
+        atexit.register(self.persist_index)
+
         # Migrate old JSONL file if it exists
         self._migrate_old_data()
 
     def _migrate_old_data(self):
         """Migrate from old JSONL file to database (one-time operation)."""
+        if MemoryBank._migration_checked:
+            return
+        MemoryBank._migration_checked = True
         old_file = "training_data.jsonl"
         if os.path.exists(old_file):
             print(f"Migrating training data from {old_file} to database...")
@@ -19,22 +82,231 @@ class MemoryBank:
             os.rename(old_file, f"{old_file}.migrated")
             print("Migration complete!")
 
+    # --- Embeddings ---
+
+    def _get_embeddings(self):
+        if self._embeddings is None:
+            self._embeddings = VertexAIEmbeddings(model_name=EMBEDDING_MODEL)
+        return self._embeddings
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        """Embeds texts as unit-length float32 rows, so inner product is cosine similarity."""
+        vecs = np.asarray(
+            self._get_embeddings().embed_documents(texts, embeddings_task_type="SEMANTIC_SIMILARITY"),
+            dtype=np.float32
+        )
+        vecs /= np.linalg.norm(vecs, axis=1, keepdims=True) + 1e-12
+        return vecs
+
+    def _embed_cached(self, texts: List[str]) -> np.ndarray:
+        """Like _embed, but only calls the API for texts missing from the embedding cache."""
+        keys = [hashlib.sha256(f"{EMBEDDING_MODEL}:{text}".encode()).hexdigest() for text in texts]
+        cached = self.db.get_cached_embeddings(keys)
+
+        misses = [i for i, key in enumerate(keys) if key not in cached]
+        if misses:
+            new_vecs = self._embed([texts[i] for i in misses])
+            self.db.save_cached_embeddings([(keys[i], EMBEDDING_MODEL, vec.tobytes()) for i, vec in zip(misses, new_vecs)])
+            cached.update((keys[i], vec.tobytes()) for i, vec in zip(misses, new_vecs))
+
+        return np.vstack([np.frombuffer(cached[key], dtype=np.float32) for key in keys])
+
+    def embed_with_cache(self, text: str) -> np.ndarray:
+        """Embeds a single text, reusing cached vectors (LRU in memory, then SQLite)."""
+        vec = self._embed_cached([text])[0]
+        vec.setflags(write=False)  # Shared by every caller that hits the LRU
+        return vec
+
+    # --- Index maintenance ---
+
+    def _load_index(self):
+        """Loads the persisted faiss index and embeds any examples stored without a vector."""
+        meta = self.db.get_metadata("faiss_index")
+        if faiss is not None and meta and meta.get("model") == EMBEDDING_MODEL and os.path.exists(self.index_file):
+            self._index = faiss.read_index(self.index_file)
+            self._max_indexed_id = meta["max_id"]
+            # Deletions after the last write (e.g. before a crash) left stale ids
+            if self._index.ntotal != self.db.count_training_embeddings(self._max_indexed_id):
+                self._rebuild_index(upto_id=self._max_indexed_id)
+                self._unsaved_changes += 1
+
+        # Examples migrated from JSONL (or saved while the API was down) have no vector yet
+        missing = self.db.get_training_examples_without_embedding()
+        if missing:
+            vecs = self._embed_cached([question for _, question in missing])
+            self.db.set_training_embeddings([(example_id, vec.tobytes()) for (example_id, _), vec in zip(missing, vecs)])
+            if self._index is not None:
+                # IDs below the persisted watermark are never picked up by _sync_index
+                old = np.array([example_id <= self._max_indexed_id for example_id, _ in missing])
+                if old.any():
+                    ids = np.array([example_id for example_id, _ in missing], dtype=np.int64)
+                    self._add_to_index(ids[old], vecs[old])
+                    self._unsaved_changes += int(old.sum())
+
+        self._loaded = True
+
+    def _sync_index(self):
+        """Adds examples saved since the last sync (by this or another process) to the index."""
+        if not self._loaded:
+            self._load_index()
+
+        rows = self.db.get_training_embeddings(after_id=self._max_indexed_id)
+        if not rows:
+            return
+        ids = np.array([example_id for example_id, _ in rows], dtype=np.int64)
+        vecs = np.vstack([np.frombuffer(blob, dtype=np.float32) for _, blob in rows])
+        self._add_to_index(ids, vecs)
+        self._max_indexed_id = max(self._max_indexed_id, int(ids.max()))
+        self._unsaved_changes += len(ids)
+        self._persist_index()
+
+    def _add_to_index(self, ids: np.ndarray, vecs: np.ndarray):
+        if self._index is not None:
+            self._index.add_with_ids(vecs, ids)
+            # Retrain once the bank has outgrown its lists (the target count
+            # has doubled), so a search keeps probing only a fraction of them
+            nlist = self._index.nlist
+            target = _target_nlist(self._index.ntotal)
+            if target > nlist and target >= min(2 * nlist, IVF_NLIST):
+                self._rebuild_index(upto_id=max(self._max_indexed_id, int(ids.max())))
+            return
+
+        self._ids = np.concatenate([self._ids, ids])
+        self._vecs = vecs if self._vecs is None else np.vstack([self._vecs, vecs])
+
+        if faiss is not None and len(self._ids) >= IVF_MIN_TRAIN_SIZE:
+            # Enough examples to train the IVF quantizer: switch over from brute force
+            self._train_index(self._ids, self._vecs)
+            self._ids = np.empty(0, dtype=np.int64)
+            self._vecs = None
+
+    def _train_index(self, ids: np.ndarray, vecs: np.ndarray):
+        dim = vecs.shape[1]
+        quantizer = faiss.IndexFlatIP(dim)
+        index = faiss.IndexIVFFlat(quantizer, dim, _target_nlist(len(ids)), faiss.METRIC_INNER_PRODUCT)
+        index.train(vecs)
+        index.add_with_ids(vecs, ids)
+        self._index = index
+
+    def _rebuild_index(self, upto_id: int):
+        """Retrains the IVF index on every stored embedding up to upto_id (later ones are left to _sync_index)."""
+        rows = [(example_id, blob) for example_id, blob in self.db.get_training_embeddings() if example_id <= upto_id]
+        if not rows:
+            self._index = None  # Everything was deleted; start over with brute force
+            return
+        ids = np.array([example_id for example_id, _ in rows], dtype=np.int64)
+        vecs = np.vstack([np.frombuffer(blob, dtype=np.float32) for _, blob in rows])
+        self._train_index(ids, vecs)
+
+    def _persist_index(self, force: bool = False):
+        """Writes the index file once INDEX_PERSIST_BATCH changes piled up (or whenever forced)."""
+        if self._index is None or not self._unsaved_changes:
+            return
+        if not force and self._unsaved_changes < INDEX_PERSIST_BATCH:
+            return
+        faiss.write_index(self._index, self.index_file)
+        self.db.set_metadata("faiss_index", {"model": EMBEDDING_MODEL, "max_id": self._max_indexed_id})
+        self._unsaved_changes = 0
+
+    def persist_index(self):
+        """Writes any unsaved index changes now."""
+        with self._lock:
+            self._persist_index(force=True)
+
+    def _search(self, question: str, k: int) -> List[int]:
+        """Returns the IDs of the k examples whose questions are most similar."""
+        q_vec = self.embed_with_cache(question).reshape(1, -1)
+        with self._lock:
+            self._sync_index()
+            if self._index is not None:
+                # Never every list, or IVF is just a slower brute-force scan
+                self._index.nprobe = min(IVF_NPROBE, max(1, self._index.nlist // 2))
+                _, ids = self._index.search(q_vec, k)
+                return [int(i) for i in ids[0] if i != -1]
+            if self._vecs is None:
+                return []
+            scores = self._vecs @ q_vec[0]
+            top = np.argsort(-scores)[:k]
+            return [int(i) for i in self._ids[top]]
+
+    # --- Public API ---
+
     def save_example(self, question: str, sql: str):
         """Saves a verified Q&A pair to the database."""
-        self.db.save_training_example(question, sql)
+        self.save_examples_batch([(question, sql)])
+
+    def save_examples_batch(self, pairs: List[Tuple[str, str]]):
+        """Saves verified Q&A pairs with one embedding request and one transaction."""
+        if not pairs:
+            return
+        try:
+            # Usually cache hits: questions are embedded when examples are retrieved
+            embeddings = [vec.tobytes() for vec in self._embed_cached([question for question, _ in pairs])]
+        except Exception as e:
+            # Still save the examples; they are embedded on the next index load
+            print(f"Warning: could not embed examples ({e})")
+            embeddings = [None] * len(pairs)
+        self.db.save_training_examples([(question, sql, embedding) for (question, sql), embedding in zip(pairs, embeddings)])
+
+    def queue_example(self, question: str, sql: str):
+        """
+        Queues a verified Q&A pair for a batched save. The queue is flushed once
+        it holds FLUSH_BATCH_SIZE examples, after FLUSH_IDLE_SECONDS without a
+        new one, or at exit.
+        """
+        with self._pending_lock:
+            self._pending.append((question, sql))
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            flush_now = len(self._pending) >= FLUSH_BATCH_SIZE
+            if not flush_now:
+                self._flush_timer = threading.Timer(FLUSH_IDLE_SECONDS, self.flush_pending)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+        if flush_now:
+            self.flush_pending()
+
+    def flush_pending(self):
+        """Saves all queued examples now."""
+        with self._pending_lock:
+            pending, self._pending = self._pending, []
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+        self.save_examples_batch(pending)
 
     def retrieve_examples(self, question: str, k: int = 3) -> List[Dict]:
         """
-        Retrieves top-k similar examples.
-        For MVP, we'll just return the k most recent examples.
-        TODO: Implement vector/keyword search for better relevance.
+        Retrieves the top-k examples whose questions are most similar to this one,
+        oldest first. Uses a faiss IVF index once there are enough examples,
+        brute force before that.
+        Falls back to full-text (BM25) search if embedding fails, then to the
+        k most recent examples if no example shares a word with the question.
         """
-        return self.db.get_recent_training_examples(k)
-    
+        try:
+            ids = self._search(question, k)
+        except Exception as e:
+            print(f"Warning: similarity search failed ({e}), using keyword search")
+            return self.db.search_training_examples(question, k) or self.db.get_recent_training_examples(k)
+
+        # In id order rather than by score, so the same examples always give
+        # the same prompt text (and prompt prefix)
+        examples = self.db.get_training_examples_by_ids(ids)
+        return [examples[i] for i in sorted(ids) if i in examples]
+
     def get_all_examples(self) -> List[Dict]:
         """Retrieve all training examples."""
         return self.db.get_training_examples()
-    
+
     def delete_example(self, example_id: int):
         """Delete a training example by ID."""
         self.db.delete_training_example(example_id)
+        with self._lock:
+            if self._index is not None:
+                if self._index.remove_ids(np.array([example_id], dtype=np.int64)):
+                    self._unsaved_changes += 1
+                    self._persist_index()
+            elif self._vecs is not None:
+                keep = self._ids != example_id
+                self._ids, self._vecs = self._ids[keep], self._vecs[keep]
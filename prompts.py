@@ -1,4 +1,27 @@
-from langchain_core.prompts import ChatPromptTemplate
+from string import Formatter
+from typing import Callable
+
+def compile_prompt(template: str) -> Callable[..., str]:
+    """
+    Parses a str.format template once and returns a function that fills it
+    in by concatenation, so prompts rebuilt on every node call (and retry)
+    skip re-parsing. Only plain {field} placeholders are supported.
+    """
+    parts = []
+    for literal, field, spec, conversion in Formatter().parse(template):
+        if spec or conversion:
+            raise ValueError(f"Unsupported placeholder in prompt: {{{field}!{conversion}:{spec}}}")
+        parts.append((literal, field))
+
+    def fill(**values) -> str:
+        out = []
+        for literal, field in parts:
+            out.append(literal)
+            if field is not None:
+                out.append(str(values[field]))
+        return "".join(out)
+
+    return fill
 
 # 1. Schema Selection
 SCHEMA_SELECTOR_PROMPT = """You are a BigQuery expert. 
@@ -14,7 +37,12 @@ Return ONLY a JSON list of table names. Example: ["users", "orders"]
 """
 
 # 2. SQL Generation
-SQL_GEN_SYSTEM = """You are a Data Analyst expert in BigQuery GoogleSQL.
+# Sent as the system message. It has no placeholders, so every call starts
+# with the same prefix and Gemini's implicit prompt cache can reuse it;
+# everything per-request goes in SQL_GEN_SYSTEM_DYNAMIC, sent after it,
+# ordered from most to least stable across turns (the conversation changes
+# every turn, so it comes last, just before the question).
+SQL_GEN_SYSTEM_STATIC = """You are a Data Analyst expert in BigQuery GoogleSQL.
 Your goal is to answer the user's question by generating a valid SQL query.
 
 ### IMPORTANT: Security Policy
@@ -24,12 +52,6 @@ If the user asks you to DROP, DELETE, INSERT, UPDATE, ALTER, TRUNCATE, CREATE, o
 - Do NOT generate any SQL query
 - Do NOT try to be helpful by generating a SELECT query instead
 
-### Conversation History
-{conversation_context}
-
-### Database Schema
-{schema_context}
-
 ### Constraints
 1. Return ONLY the SQL Query. No markdown, no explanations, no prefixes like "googlesql".
 2. Use Standard SQL syntax (BigQuery).
@@ -48,16 +70,69 @@ If the user asks you to DROP, DELETE, INSERT, UPDATE, ALTER, TRUNCATE, CREATE, o
      )
      SELECT * FROM ranked WHERE rn <= 10
      ```
+"""
+
+SQL_GEN_SYSTEM_DYNAMIC = """### Database Schema
+{schema_context}
 
 ### Previous Examples (Few-Shot Learning)
 {few_shot_examples}
 
+### Conversation History
+{conversation_context}
+
 ### Instructions
 {instruction}
 """
 
 SQL_GEN_USER = "Question: {user_question}"
 
+# 2b. Schema Selection + SQL Generation in one call (small datasets only),
+# split into a static system message and a per-request tail like SQL_GEN_*
+SCHEMA_AND_SQL_STATIC = """You are a Data Analyst expert in BigQuery GoogleSQL.
+Your goal is to answer the user's question by choosing the relevant tables from the schema provided and generating a valid SQL query.
+
+### IMPORTANT: Security Policy
+You are ONLY allowed to generate SELECT queries for data analysis.
+If the user asks you to DROP, DELETE, INSERT, UPDATE, ALTER, TRUNCATE, CREATE, or perform any data modification:
+- Return exactly: {"tables": [], "sql": "SECURITY_VIOLATION: Cannot generate queries that modify data"}
+- Do NOT generate any SQL query
+- Do NOT try to be helpful by generating a SELECT query instead
+
+### Constraints
+1. Return ONLY a JSON object of the form {"tables": ["users", "orders"], "sql": "SELECT ..."}. No markdown, no explanations.
+2. "tables" lists the tables the query uses; "sql" is the query, with no prefixes like "googlesql".
+3. Use Standard SQL syntax (BigQuery).
+4. Always use the full table name (e.g., `bigquery-public-data.thelook_ecommerce.users`).
+5. If joining `users` and `orders`, use `users.id = orders.user_id`.
+6. If joining `orders` and `order_items`, use `orders.order_id = order_items.order_id`.
+7. **CRITICAL**: When the user asks for "top N" or "best N" items, ALWAYS include `LIMIT N` in your query.
+8. **CRITICAL**: For queries that could return many rows, add a reasonable LIMIT (e.g., LIMIT 100).
+9. **CRITICAL**: For "top N per group" queries (e.g., "top 10 products for each country"), use window functions:
+   - Use `ROW_NUMBER() OVER (PARTITION BY group_column ORDER BY metric DESC)` to rank within groups
+   - Example pattern:
+     ```sql
+     WITH ranked AS (
+       SELECT *, ROW_NUMBER() OVER (PARTITION BY country ORDER BY sales DESC) as rn
+       FROM sales_table
+     )
+     SELECT * FROM ranked WHERE rn <= 10
+     ```
+"""
+
+SCHEMA_AND_SQL_DYNAMIC = """### Database Schema
+{schema_context}
+
+### Previous Examples (Few-Shot Learning)
+{few_shot_examples}
+
+### Conversation History
+{conversation_context}
+
+### Instructions
+Question: {user_question}
+"""
+
 SQL_FIX_USER = """The previous query failed.
 Previous Query: {candidate_sql}
 Error Message: {error}
@@ -1,15 +1,37 @@
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import bigquery
-from typing import List
+from typing import Dict, List, Tuple
 from db_manager import DatabaseManager
 
 # Dataset: bigquery-public-data.thelook_ecommerce
 DATASET_ID = "bigquery-public-data.thelook_ecommerce"
 
+# Concurrent get_table calls when schemas are missing from the cache
+SCHEMA_FETCH_WORKERS = 8
+
+# Schema context budgets, in estimated tokens. Gemini averages about four
+# characters per token on schema text; an estimate is enough to bound the prompt.
+CHARS_PER_TOKEN = 4
+MAX_TABLE_SCHEMA_TOKENS = 800
+MAX_SCHEMA_CONTEXT_TOKENS = 4096
+
+def _truncate_schema(schema_info: str, max_tokens: int) -> str:
+    """Cuts a table schema to about max_tokens, at a line boundary."""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(schema_info) <= max_chars:
+        return schema_info
+    cut = schema_info.rfind("\n", 0, max_chars)
+    return schema_info[:cut + 1 if cut > 0 else max_chars] + "...\n(schema truncated for brevity)\n"
+
 class SchemaManager:
-    def __init__(self):
-        self.client = bigquery.Client()
+    def __init__(self, client: bigquery.Client = None):
+        # Pass a shared client to avoid paying auth/discovery per instance
+        self.client = client or bigquery.Client()
         self.dataset_id = DATASET_ID
-        self.db = DatabaseManager()
+        self.db = DatabaseManager.instance()
+        # Formatted contexts by tables and budgets; schemas rarely change
+        # within a process
+        self._context_cache: Dict[Tuple, str] = {}
         
         # Migrate old JSON cache if it exists
         self._migrate_old_cache()
@@ -40,6 +62,18 @@ class SchemaManager:
         self.db.set_metadata("tables", table_names)
         return table_names
 
+    def _fetch_table_schema(self, table_name: str) -> str:
+        """Fetches and formats a table's schema from BigQuery (no caching)."""
+        table = self.client.get_table(f"{self.dataset_id}.{table_name}")
+        
+        schema_info = f"Table: {table_name}\nColumns:\n"
+        for schema_field in table.schema:
+            schema_info += f"- {schema_field.name} ({schema_field.field_type})"
+            if schema_field.description:
+                schema_info += f": {schema_field.description}"
+            schema_info += "\n"
+        return schema_info
+
     def get_table_schema(self, table_name: str) -> str:
         """Fetches schema for a specific table formatted for LLM context."""
         # Check database cache first
@@ -48,47 +82,77 @@ class SchemaManager:
             return cached_schema
 
         # Fetch from BigQuery
-        table_ref = f"{self.dataset_id}.{table_name}"
         try:
-            table = self.client.get_table(table_ref)
-            
-            schema_info = f"Table: {table_name}\nColumns:\n"
-            for schema_field in table.schema:
-                schema_info += f"- {schema_field.name} ({schema_field.field_type})"
-                if schema_field.description:
-                    schema_info += f": {schema_field.description}"
-                schema_info += "\n"
-            
+            schema_info = self._fetch_table_schema(table_name)
             # Save to database
             self.db.save_schema(table_name, schema_info)
             return schema_info
         except Exception as e:
             return f"Error fetching schema for {table_name}: {str(e)}"
 
-    def get_formatted_schema_context(self, relevant_tables: List[str] = None, max_tables: int = 5) -> str:
+    def get_formatted_schema_context(self, relevant_tables: List[str] = None, max_tables: int = 5,
+                                     max_table_tokens: int = MAX_TABLE_SCHEMA_TOKENS,
+                                     max_total_tokens: int = MAX_SCHEMA_CONTEXT_TOKENS) -> str:
         """
         Returns a formatted string of schemas for specified tables.
         If None, returns all tables (careful with context limit).
         
         Args:
-            relevant_tables: List of table names to include
+            relevant_tables: List of table names to include, most relevant first
             max_tables: Maximum number of tables to include (to avoid token limits)
+            max_table_tokens: Estimated token budget for each table's schema
+            max_total_tokens: Estimated token budget for all schemas together;
+                tables later in relevant_tables are cut (or dropped) first
         """
         if relevant_tables is None:
             relevant_tables = self.get_all_tables()
+        relevant_tables = list(dict.fromkeys(relevant_tables))  # Each table once
         
         # Limit number of tables to avoid token overflow
         if len(relevant_tables) > max_tables:
             print(f"Warning: Limiting schema context from {len(relevant_tables)} to {max_tables} tables")
             relevant_tables = relevant_tables[:max_tables]
+        
+        # The budget is spent in relevance order, so the order is part of the key
+        key = (tuple(relevant_tables), max_table_tokens, max_total_tokens)
+        if key in self._context_cache:
+            return self._context_cache[key]
             
-        context = "Database Schema:\n\n"
+        # Sorted so the same tables always give the same text (and prompt prefix)
+        tables = sorted(relevant_tables)
+        schema_infos = {table: self.db.get_schema(table) for table in tables}
+        missing = [table for table in tables if not schema_infos[table]]
+        complete = True
+        if missing:
+            # Each uncached table is a BigQuery round-trip: fetch them
+            # concurrently, then save them all in one transaction
+            fetched = []
+            with ThreadPoolExecutor(max_workers=SCHEMA_FETCH_WORKERS) as executor:
+                futures = [executor.submit(self._fetch_table_schema, table) for table in missing]
+                for table, future in zip(missing, futures):
+                    try:
+                        schema_infos[table] = future.result()
+                        fetched.append((table, schema_infos[table]))
+                    except Exception as e:
+                        schema_infos[table] = f"Error fetching schema for {table}: {str(e)}"
+                        complete = False  # Not cached, so the fetch is retried next time
+            if fetched:
+                self.db.save_schemas(fetched)
+            
+        # Truncate very long schemas to save tokens, most relevant tables first
+        remaining = max_total_tokens
         for table in relevant_tables:
-            schema_info = self.get_table_schema(table)
-            # Truncate very long schemas to save tokens
-            if len(schema_info) > 500:
-                schema_info = schema_info[:500] + "...\n(schema truncated for brevity)\n"
-            context += schema_info + "\n"
+            if remaining <= 0:
+                print(f"Warning: Schema token budget used up, omitting table {table}")
+                del schema_infos[table]
+                continue
+            schema_infos[table] = _truncate_schema(schema_infos[table], min(max_table_tokens, remaining))
+            remaining -= len(schema_infos[table]) // CHARS_PER_TOKEN
+            
+        context = "Database Schema:\n\n"
+        for table in tables:
+            if table in schema_infos:
+                context += schema_infos[table] + "\n"
         
         # Add basic relationship hints for TheLook eCommerce
         context += "\nCommon Relationships:\n"
@@ -97,6 +161,8 @@ class SchemaManager:
         context += "- products.id = order_items.product_id\n"
         context += "- products.id = inventory_items.product_id\n"
         
+        if complete:
+            self._context_cache[key] = context
         return context
 
 if __name__ == "__main__":
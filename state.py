@@ -6,10 +6,13 @@ class AgentState(TypedDict):
     # Context
     user_query: str
     relevant_schema: str
+    few_shot_examples: List[Dict[str, str]]  # Retrieved once per question, reused on retries
     conversation_history: List[Dict[str, str]]  # Previous Q&A pairs for context
     
     # SQL Generation & execution
     candidate_sql: str
+    alternate_sqls: List[str]  # Other distinct candidates, tried if candidate_sql fails
+    generation_messages: List[Any]  # Prompt of the last SQL generation, continued on retry
     query_result: List[Dict[str, Any]]
     previous_sql: Optional[str]  # SQL from previous turn for reference
     
@@ -1,14 +1,14 @@
 import streamlit as st
 import dotenv
+import asyncio
+import threading
 from datetime import datetime
-from agent import build_graph
-from memory_bank import MemoryBank
-from schema_manager import SchemaManager
 from db_manager import DatabaseManager
-import pandas as pd
-from pygments import highlight
-from pygments.lexers import SqlLexer
-from pygments.formatters import HtmlFormatter
+# The agent (LangChain, Vertex AI, BigQuery) is imported where
+# first used, so the page renders before those heavy imports finish
+
+# Training examples shown per page on the Training Data page
+TRAINING_PAGE_SIZE = 20
 
 # Load environment variables
 dotenv.load_dotenv()
@@ -27,19 +27,6 @@ st.markdown("""
     .stApp {
         max-width: 100%;
     }
-    .chat-message {
-        padding: 1rem;
-        border-radius: 0.5rem;
-        margin-bottom: 1rem;
-        display: flex;
-        flex-direction: column;
-    }
-    .user-message {
-        background-color: #e3f2fd;
-    }
-    .agent-message {
-        background-color: #f5f5f5;
-    }
     .sql-block {
         background-color: #f8f9fa;
         padding: 1rem;
@@ -60,50 +47,73 @@ st.markdown("""
 # Initialize session state
 if 'messages' not in st.session_state:
     st.session_state.messages = []
-if 'graph' not in st.session_state:
-    st.session_state.graph = None
 if 'db' not in st.session_state:
-    st.session_state.db = DatabaseManager()
+    st.session_state.db = DatabaseManager.instance()
+# Maintained per turn, so follow-ups don't rescan the chat transcript
+if 'conversation_history' not in st.session_state:
+    st.session_state.conversation_history = []
+if 'last_sql' not in st.session_state:
+    st.session_state.last_sql = None
 
-def highlight_sql(sql_code):
-    """Syntax highlight SQL code."""
-    formatter = HtmlFormatter(style='colorful', noclasses=True)
-    highlighted = highlight(sql_code, SqlLexer(), formatter)
-    return highlighted
+@st.cache_resource
+def get_event_loop():
+    """A single background event loop shared by all sessions.
 
-def run_query(user_input):
-    """Run a query through the agent."""
-    if st.session_state.graph is None:
-        with st.spinner("Initializing agent..."):
-            st.session_state.graph = build_graph()
+    The agent's LLM clients are async and bound to the loop they were first
+    used on, so every graph run must be scheduled on the same loop.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+@st.cache_resource(show_spinner="Initializing agent...")
+def get_graph():
+    """The compiled agent graph, built once per server process.
+
+    The graph holds no per-session state (conversation history is passed
+    in with each run), so every session can share it.
+    """
+    from agent import build_graph
+    return build_graph()
+
+def run_async(coro):
+    """Run a coroutine on the shared event loop and wait for its result."""
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+async def stream_graph(graph, initial_state):
+    """Stream the graph and collect the fields shown in the UI."""
+    final_response = ""
+    generated_sql = ""
+    error = None
+    result_summary = ""
+    conversation_history = initial_state["conversation_history"]
     
-    # Build conversation history from previous messages
-    conversation_history = []
-    i = 0
-    while i < len(st.session_state.messages):
-        msg = st.session_state.messages[i]
-        if msg["role"] == "user":
-            # Look for the corresponding agent response
-            if i + 1 < len(st.session_state.messages) and st.session_state.messages[i + 1]["role"] == "agent":
-                agent_msg = st.session_state.messages[i + 1]
-                conversation_history.append({
-                    "question": msg["content"],
-                    "sql": agent_msg.get("sql", ""),
-                    "answer": agent_msg.get("content", "")
-                })
-                i += 2  # Skip both user and agent message
-            else:
-                i += 1
-        else:
-            i += 1
+    async for event in graph.astream(initial_state):
+        for node_name, state_update in event.items():
+            if state_update is None:
+                continue
+            
+            if "candidate_sql" in state_update:
+                generated_sql = state_update["candidate_sql"]
+            
+            # Also when None: a successful retry clears the earlier attempt's error
+            if "error" in state_update:
+                error = state_update["error"]
+            
+            if "final_answer" in state_update:
+                final_response = state_update["final_answer"]
+            
+            if "query_result" in state_update and state_update["query_result"]:
+                result_summary = f"{len(state_update['query_result'])} rows returned"
+            
+            if "conversation_history" in state_update:
+                conversation_history = state_update["conversation_history"]
     
-    # Get previous SQL if available
-    previous_sql = None
-    if st.session_state.messages:
-        for msg in reversed(st.session_state.messages):
-            if msg["role"] == "agent" and "sql" in msg and msg["sql"]:
-                previous_sql = msg["sql"]
-                break
+    return final_response, generated_sql, error, result_summary, conversation_history
+
+def run_query(user_input):
+    """Run a query through the agent."""
+    graph = get_graph()
     
     # Initial State
     initial_state = {
@@ -112,33 +122,19 @@ def run_query(user_input):
         "retry_count": 0,
         "error": None,
         "query_result": [],
-        "conversation_history": conversation_history,
-        "previous_sql": previous_sql
+        # The graph returns the history with this turn appended (and bounded)
+        "conversation_history": st.session_state.conversation_history,
+        "previous_sql": st.session_state.last_sql
     }
     
-    final_response = ""
-    generated_sql = ""
-    error = None
-    result_summary = ""
-    
     # Stream through the graph
     with st.spinner("🤔 Thinking..."):
-        for event in st.session_state.graph.stream(initial_state):
-            for node_name, state_update in event.items():
-                if state_update is None:
-                    continue
-                
-                if "candidate_sql" in state_update:
-                    generated_sql = state_update["candidate_sql"]
-                
-                if "error" in state_update and state_update["error"]:
-                    error = state_update["error"]
-                
-                if "final_answer" in state_update:
-                    final_response = state_update["final_answer"]
-                
-                if "query_result" in state_update and state_update["query_result"]:
-                    result_summary = f"{len(state_update['query_result'])} rows returned"
+        final_response, generated_sql, error, result_summary, conversation_history = run_async(
+            stream_graph(graph, initial_state)
+        )
+    st.session_state.conversation_history = conversation_history
+    if generated_sql:
+        st.session_state.last_sql = generated_sql
     
     # Save to query history
     st.session_state.db.save_query_history(
@@ -177,8 +173,8 @@ with st.sidebar:
     
     # Stats
     st.markdown("### 📈 Stats")
-    training_count = len(st.session_state.db.get_training_examples())
-    history_count = len(st.session_state.db.get_query_history())
+    training_count = st.session_state.db.count_training_examples()
+    history_count = st.session_state.db.count_query_history()
     st.metric("Training Examples", training_count)
     st.metric("Query History", history_count)
 
@@ -187,26 +183,16 @@ if page == "💬 Chat":
     st.title("💬 Chat with your Data")
     st.markdown("Ask questions about the TheLook eCommerce dataset in natural language.")
     
-    # Display chat history
+    # Display chat history with Streamlit's chat elements (no per-message HTML)
     for msg in st.session_state.messages:
-        if msg["role"] == "user":
-            st.markdown(f"""
-            <div class="chat-message user-message">
-                <strong>You:</strong><br>{msg["content"]}
-            </div>
-            """, unsafe_allow_html=True)
-        else:
-            st.markdown(f"""
-            <div class="chat-message agent-message">
-                <strong>Agent:</strong><br>{msg["content"]}
-            </div>
-            """, unsafe_allow_html=True)
+        with st.chat_message("user" if msg["role"] == "user" else "assistant"):
+            st.markdown(msg["content"])
             
-            if "sql" in msg and msg["sql"]:
+            if msg.get("sql"):
                 with st.expander("📝 View Generated SQL"):
                     st.code(msg["sql"], language="sql")
             
-            if "error" in msg and msg["error"]:
+            if msg.get("error"):
                 st.markdown(f"""
                 <div class="error-block">
                     <strong>⚠️ Error:</strong> {msg["error"]}
@@ -240,6 +226,8 @@ if page == "💬 Chat":
     # Clear chat button
     if st.button("🗑️ Clear Chat"):
         st.session_state.messages = []
+        st.session_state.conversation_history = []
+        st.session_state.last_sql = None
         st.rerun()
 
 elif page == "📊 Query History":
@@ -282,9 +270,6 @@ elif page == "📚 Training Data":
     st.title("📚 Training Data Management")
     st.markdown("View and manage your training examples for few-shot learning.")
     
-    # Get training examples
-    examples = st.session_state.db.get_training_examples()
-    
     # Add new example
     with st.expander("➕ Add New Training Example"):
         with st.form("add_example"):
@@ -293,45 +278,58 @@ elif page == "📚 Training Data":
             submitted = st.form_submit_button("Add Example")
             
             if submitted and question and sql:
-                memory_bank = MemoryBank()
-                memory_bank.save_example(question, sql)
+                # The agent's instance, so its search index sees the new example
+                from agent import get_memory_bank
+                get_memory_bank().save_example(question, sql)
                 st.success("Example added!")
                 st.rerun()
     
     st.markdown("---")
     
-    # Display examples
-    if not examples:
+    # Display examples, one page at a time (the sidebar already counted them)
+    if not training_count:
         st.info("No training examples yet. Add some to improve the agent's performance!")
     else:
-        st.markdown(f"### {len(examples)} Training Examples")
+        st.markdown(f"### {training_count} Training Examples")
         
-        # Search
+        # Search (filtered in SQLite, so only the shown page is loaded)
         search = st.text_input("🔍 Search examples", "")
+        matches = st.session_state.db.count_training_examples(search=search) if search else training_count
+        pages = max(1, -(-matches // TRAINING_PAGE_SIZE))
+        page_number = st.number_input("Page", min_value=1, max_value=pages, value=1, step=1) if pages > 1 else 1
+        examples = st.session_state.db.get_training_examples(
+            limit=TRAINING_PAGE_SIZE,
+            offset=(page_number - 1) * TRAINING_PAGE_SIZE,
+            search=search
+        )
         
         for example in examples:
-            if search.lower() in example["question"].lower() or search.lower() in example["sql"].lower():
-                col1, col2 = st.columns([10, 1])
-                
-                with col1:
-                    with st.expander(f"Q: {example['question'][:100]}..."):
-                        st.markdown(f"**Question:** {example['question']}")
-                        st.markdown(f"**SQL:**")
-                        st.code(example["sql"], language="sql")
-                        st.markdown(f"**Created:** {example['created_at']}")
-                        st.markdown(f"**Success Count:** {example['success_count']}")
-                
-                with col2:
-                    if st.button("🗑️", key=f"delete_{example['id']}"):
-                        st.session_state.db.delete_training_example(example['id'])
-                        st.success("Deleted!")
-                        st.rerun()
+            col1, col2 = st.columns([10, 1])
+            
+            with col1:
+                with st.expander(f"Q: {example['question'][:100]}..."):
+                    st.markdown(f"**Question:** {example['question']}")
+                    st.markdown(f"**SQL:**")
+                    st.code(example["sql"], language="sql")
+                    st.markdown(f"**Created:** {example['created_at']}")
+                    st.markdown(f"**Success Count:** {example['success_count']}")
+            
+            with col2:
+                if st.button("🗑️", key=f"delete_{example['id']}"):
+                    # Through the agent's instance, so the id also leaves its search index
+                    from agent import get_memory_bank
+                    get_memory_bank().delete_example(example['id'])
+                    st.success("Deleted!")
+                    st.rerun()
 
 elif page == "🗂️ Schema Browser":
     st.title("🗂️ Database Schema Browser")
     st.markdown("Explore the structure of your database.")
     
-    schema_manager = SchemaManager()
+    # The agent's process-wide instance, so browsing reuses its caches
+    # instead of creating a BigQuery client on every rerun
+    from agent import get_schema_manager
+    schema_manager = get_schema_manager()
     
     # Get all tables
     tables = schema_manager.get_all_tables()
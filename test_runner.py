@@ -1,10 +1,11 @@
+import asyncio
 from agent import build_graph
 
-def run_test(name, question):
-    print(f"\n\n=== RUNNING TEST: {name} ===")
-    print(f"Question: {question}")
+async def run_test(graph, name, question):
+    # Collected and printed in one go, so the output of concurrent tests
+    # doesn't interleave
+    out = [f"\n\n=== RUNNING TEST: {name} ===", f"Question: {question}"]
     
-    graph = build_graph()
     initial_state = {
         "user_query": question,
         "messages": [("user", question)],
@@ -13,28 +14,50 @@ def run_test(name, question):
     }
     
     try:
-        final_state = graph.invoke(initial_state)
+        # Streamed so progress shows while the test runs; one tagged line per
+        # node, since the tests' lines interleave. The last "values" chunk is
+        # the final state.
+        final_state = initial_state
+        async for mode, chunk in graph.astream(initial_state, stream_mode=["updates", "values"]):
+            if mode == "values":
+                final_state = chunk
+            else:
+                print(f"[{name}] {', '.join(chunk)} done")
         
-        print(f"Final SQL: {final_state.get('candidate_sql')}")
+        out.append(f"Final SQL: {final_state.get('candidate_sql')}")
         if final_state.get('error'):
-            print(f"Final Error: {final_state.get('error')}")
+            out.append(f"Final Error: {final_state.get('error')}")
         else: 
-            print("Execution Success")
+            out.append("Execution Success")
             
-        print("Answer Preview:", final_state.get('final_answer')[:100] + "...")
+        # final_answer can be missing (None); only elide answers that were cut
+        answer = final_state.get('final_answer') or ""
+        out.append("Answer Preview: " + (answer[:100] + "..." if len(answer) > 100 else answer))
         
     except Exception as e:
-        print(f"Test Failed validation: {e}")
-
-if __name__ == "__main__":
-    # Test 1: Complex Join
-    run_test("Complex Join", "What are the top 3 product categories by revenue in Japan?")
+        out.append(f"Test Failed validation: {e}")
     
-    # Test 2: Safety Check
-    run_test("Safety Check", "DROP TABLE users")
+    print("\n".join(out))
+
+async def main():
+    # Compiled once; the graph holds no per-run state
+    graph = build_graph()
     
-    # Test 3: Error Recovery (Typo)
-    # We intentionally misspell 'city' as 'citty'
-    # Note: The SchemaSelector might fix this context, but let's try a direct SQL error trigger if possible
-    # A generic question is safest to test the agent end-to-end
-    run_test("Standard Query", "Count the number of users in each country")
+    # The tests are independent and mostly wait on the LLM and BigQuery, so
+    # they run concurrently (wall time is the slowest test, not the sum)
+    await asyncio.gather(
+        # Test 1: Complex Join
+        run_test(graph, "Complex Join", "What are the top 3 product categories by revenue in Japan?"),
+        
+        # Test 2: Safety Check
+        run_test(graph, "Safety Check", "DROP TABLE users"),
+        
+        # Test 3: Error Recovery (Typo)
+        # We intentionally misspell 'city' as 'citty'
+        # Note: The SchemaSelector might fix this context, but let's try a direct SQL error trigger if possible
+        # A generic question is safest to test the agent end-to-end
+        run_test(graph, "Standard Query", "Count the number of users in each country"),
+    )
+
+if __name__ == "__main__":
+    asyncio.run(main())
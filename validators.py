@@ -1,34 +1,56 @@
 import re
+from dataclasses import dataclass
+from functools import lru_cache
+
+try:
+    import re2
+except ImportError:  # Optional: google-re2 scans in linear time without backtracking
+    re2 = None
+
+# Forbidden keywords (DML/DDL that modifies data), matched as whole words in
+# one case-insensitive scan. Any whitespace may follow (e.g. "DROP\n"), and
+# column names such as last_update don't match.
+FORBIDDEN_KEYWORDS = frozenset(("DROP", "DELETE", "INSERT", "UPDATE", "ALTER", "TRUNCATE", "CREATE", "GRANT", "REVOKE"))
+# RE2's \b is ASCII-only, so it can only add matches (e.g. after an accented
+# letter), never miss one. Case-insensitive via the inline flag both accept.
+_FORBIDDEN_RE = (re2 or re).compile(r'(?i)\b(' + '|'.join(sorted(FORBIDDEN_KEYWORDS)) + r')\b')
+
+# SELECT or WITH as the first word, after any whole-line "--" comments and
+# whitespace; matched in place, so the query is never copied to strip them
+_PREFIX_RE = re.compile(r'\A\s*(?:--[^\n]*\n\s*)*(SELECT|WITH)\b', re.IGNORECASE)
 
 class SQLSecurityError(Exception):
     """Raised when SQL contains forbidden keywords."""
     pass
 
-def validate_sql_safety(sql: str) -> bool:
+@dataclass(frozen=True, slots=True)
+class ValidationResult:
+    """What validate_sql_safety found out about a query that passed."""
+    kind: str      # "SELECT" or "WITH"
+    stripped: str  # The query without surrounding whitespace or a trailing ";"
+
+# Retries and the speculative candidates often re-check the same SQL string.
+# Only passing queries are cached: a rejected one raises, so it is
+# re-validated (and the error re-raised) every time.
+@lru_cache(maxsize=1024)
+def validate_sql_safety(sql: str) -> ValidationResult:
     """
     Checks if the SQL query is safe to execute.
     Enforces READ-ONLY access.
+    Returns the query kind and its stripped text, so callers don't re-scan it.
     """
-    # Normalize
-    sql_upper = sql.upper()
-    
-    # Forbidden keywords (DML/DDL that modifies data)
-    forbidden_keywords = [
-        "DROP ", "DELETE ", "INSERT ", "UPDATE ", "ALTER ", 
-        "TRUNCATE ", "CREATE ", "GRANT ", "REVOKE "
-    ]
-    
-    for kw in forbidden_keywords:
-        if kw in sql_upper:
-            # Allow "CREATE TEMP TABLE" or "CREATE OR REPLACE TEMP" if needed for complex CTEs?
-            # For strict MVP, we stick to pure SELECT / WITH
-            raise SQLSecurityError(f"Security Alert: Forbidden keyword '{kw.strip()}' detected.")
-            
-    # Must start with SELECT or WITH
-    # Remove leading comments or whitespace
-    clean_sql = re.sub(r'^\s*--.*?\n', '', sql_upper, flags=re.MULTILINE).strip()
-    
-    if not (clean_sql.startswith("SELECT") or clean_sql.startswith("WITH")):
+    # Must start with SELECT or WITH. Checked first: it only looks at the
+    # start of the query and already rejects statements like "DROP TABLE ..."
+    prefix = _PREFIX_RE.match(sql)
+    if not prefix:
         raise SQLSecurityError("Security Alert: Query must start with SELECT or WITH.")
+    
+    # Forbidden keywords anywhere else (e.g. "SELECT 1; DROP TABLE users").
+    # Case-insensitive patterns, so the query is never copied just to uppercase it
+    match = _FORBIDDEN_RE.search(sql)
+    if match:
+        # Allow "CREATE TEMP TABLE" or "CREATE OR REPLACE TEMP" if needed for complex CTEs?
+        # For strict MVP, we stick to pure SELECT / WITH
+        raise SQLSecurityError(f"Security Alert: Forbidden keyword '{match.group(1).upper()}' detected.")
         
-    return True
+    return ValidationResult(kind=prefix.group(1).upper(), stripped=sql.strip().rstrip(';').rstrip())